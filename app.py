@@ -7,6 +7,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import base64
 from io import BytesIO
+from session_store import SessionStore
 
 app = Flask(__name__)
 
@@ -16,8 +17,35 @@ ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
 # Initialize the Anthropic client
 client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
 
-# Store active sessions
-sessions = {}
+INITIAL_MESSAGE = "Hello, I'm the owner of Offshoot Intermediaries Limited. I understand you have a 1,000-kilogram lot of premium-quality cinnamon powder available. I'm interested in discussing a potential purchase."
+
+# Session persistence settings (see session_store.py):
+#   SESSION_DATA_DIR           directory for the session log and snapshots. It must
+#                              be on storage that survives restarts. A Heroku dyno's
+#                              own filesystem is wiped on every restart, so there
+#                              this must point at a mounted persistent volume, or
+#                              persistence does nothing; when it is unset on a dyno,
+#                              persistence is switched off with a warning. Locally
+#                              it defaults to ./session_data. Only one process may
+#                              use a data directory, so run a single gunicorn
+#                              worker (e.g. WEB_CONCURRENCY=1) when it is set.
+#   SESSION_SNAPSHOT_INTERVAL  logged turns between snapshots (default 5000)
+#   SESSION_TTL_HOURS          idle hours before a session expires (default 24)
+#   SESSION_LOG_FSYNC          fsync each turn before replying (default true)
+SESSION_DATA_DIR = os.environ.get("SESSION_DATA_DIR")
+if not SESSION_DATA_DIR:
+    if "DYNO" in os.environ:
+        app.logger.warning(
+            "SESSION_DATA_DIR is not set; session persistence is disabled because the dyno "
+            "filesystem is wiped on restart. Point SESSION_DATA_DIR at persistent storage "
+            "to keep negotiations across restarts.")
+    else:
+        SESSION_DATA_DIR = "session_data"
+SNAPSHOT_INTERVAL = int(os.environ.get("SESSION_SNAPSHOT_INTERVAL", 5000))
+SESSION_TTL = float(os.environ.get("SESSION_TTL_HOURS", 24)) * 3600
+SESSION_LOG_FSYNC = os.environ.get("SESSION_LOG_FSYNC", "true").lower() == "true"
+
+FLASK_DEBUG = os.environ.get('FLASK_DEBUG', 'false').lower() == 'true'
 
 def generate_cinnamon_buyer_prompt():
     """Generate the system prompt for the Cinnamon Case buyer"""
@@ -52,6 +80,15 @@ def generate_cinnamon_buyer_prompt():
     """
     return prompt
 
+def session_log_zdict():
+    """Preset dictionary for session log compression, built from text every conversation shares"""
+    return (generate_cinnamon_buyer_prompt() + INITIAL_MESSAGE).encode('utf-8')[-32768:]
+
+# Store active sessions
+sessions = SessionStore(SESSION_DATA_DIR, session_log_zdict(),
+                        snapshot_interval=SNAPSHOT_INTERVAL, ttl=SESSION_TTL,
+                        fsync=SESSION_LOG_FSYNC)
+
 def calculate_profit_split(agreed_price):
     """Calculate the profit split between buyer and seller based on the agreed price"""
     # Seller's calculations
@@ -205,17 +242,12 @@ def start_session():
     import uuid
     session_id = str(uuid.uuid4())
     
-    # Initial message
-    initial_message = "Hello, I'm the owner of Offshoot Intermediaries Limited. I understand you have a 1,000-kilogram lot of premium-quality cinnamon powder available. I'm interested in discussing a potential purchase."
-    
     # Store session
-    sessions[session_id] = {
-        'conversation': [{"role": "assistant", "content": initial_message}]
-    }
+    sessions.append(session_id, "assistant", INITIAL_MESSAGE)
     
     return jsonify({
         'session_id': session_id,
-        'message': initial_message
+        'message': INITIAL_MESSAGE
     })
 
 @app.route('/api/chat', methods=['POST'])
@@ -228,7 +260,7 @@ def chat():
         return jsonify({'error': 'Invalid session'}), 400
     
     # Add message to conversation
-    sessions[session_id]['conversation'].append({"role": "user", "content": message})
+    sessions.append(session_id, "user", message)
     
     # Get system prompt
     system_prompt = generate_cinnamon_buyer_prompt()
@@ -238,14 +270,14 @@ def chat():
         model="claude-3-7-sonnet-20250219",
         max_tokens=1000,
         system=system_prompt,
-        messages=sessions[session_id]['conversation']
+        messages=sessions.messages(session_id)
     )
     
     # Get response
     buyer_response = response.content[0].text
     
     # Add to conversation
-    sessions[session_id]['conversation'].append({"role": "assistant", "content": buyer_response})
+    sessions.append(session_id, "assistant", buyer_response)
     
     return jsonify({
         'message': buyer_response
@@ -269,7 +301,13 @@ def debrief():
         'chart': chart_image
     })
 
+# Restore in-progress negotiations from the previous process. With FLASK_DEBUG
+# the Werkzeug reloader first runs this file in a parent process that only
+# watches for changes, so leave the data directory to the serving child.
+if __name__ != '__main__' or not FLASK_DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    sessions.recover()
+
 #if __name__ == '__main__':
    
     # Run the app
-app.run(debug=os.environ.get('FLASK_DEBUG', 'false').lower() == 'true', host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
\ No newline at end of file
+app.run(debug=FLASK_DEBUG, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
\ No newline at end of file
@@ -0,0 +1,385 @@
+"""Crash-recoverable storage for in-progress negotiation sessions
+
+Every turn is appended to a log segment in the data directory as a
+sequence-numbered, CRC-checked record compressed with zlib against a preset
+dictionary. Every `snapshot_interval` turns the live table is copied, new turns
+switch to a fresh segment, and a background thread writes the copy to a
+compressed snapshot and deletes the segments it covers. On startup the table
+is rebuilt from the snapshot plus any newer segments.
+
+Files in the data directory:
+    sessions.lock              held (flock) by the one process that owns the dir
+    sessions.zdict             compression dictionary the current segments use
+    sessions.snapshot          zlib-compressed JSON of the table at some seq
+    sessions.<first_seq>.log   log segments
+    *.corrupt.<time>           unreadable snapshots or segments set aside at recovery
+"""
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+ROLES = ("user", "assistant")
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+
+# Log record header: sequence number, payload length, payload CRC32
+LOG_HEADER = struct.Struct(">QII")
+
+LOCK_NAME = "sessions.lock"
+ZDICT_NAME = "sessions.zdict"
+SNAPSHOT_NAME = "sessions.snapshot"
+SEGMENT_PREFIX = "sessions."
+SEGMENT_SUFFIX = ".log"
+
+# Errors that mean a record or snapshot is unreadable rather than a bug
+DECODE_ERRORS = (zlib.error, ValueError, TypeError, KeyError, IndexError)
+
+
+def encode_turn(zdict, session_id, role_code, content, timestamp):
+    """Encode one turn as a compressed log payload"""
+    raw = json.dumps([session_id, role_code, content, timestamp], separators=(',', ':')).encode('utf-8')
+    compressor = zlib.compressobj(level=6, zdict=zdict)
+    return compressor.compress(raw) + compressor.flush()
+
+
+def decode_turn(zdict, payload):
+    """Decode a compressed log payload into (session_id, role_code, content, timestamp)"""
+    decompressor = zlib.decompressobj(zdict=zdict)
+    session_id, role_code, content, timestamp = json.loads(decompressor.decompress(payload) + decompressor.flush())
+    return session_id, role_code, content, timestamp
+
+
+def read_log(path):
+    """Yield (seq, payload) for each intact record in a segment, stopping at a torn or corrupt tail"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset + LOG_HEADER.size <= len(data):
+        seq, length, crc = LOG_HEADER.unpack_from(data, offset)
+        start = offset + LOG_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        yield seq, payload
+        offset = start + length
+    if offset != len(data):
+        logger.warning("Ignoring %d bytes of torn or corrupt records at the end of %s",
+                       len(data) - offset, path)
+
+
+def segment_name(first_seq):
+    return "%s%020d%s" % (SEGMENT_PREFIX, first_seq, SEGMENT_SUFFIX)
+
+
+class Session:
+    """One negotiation: its turns as (role_code, content) tuples and last activity time"""
+    __slots__ = ('turns', 'last_active')
+
+    def __init__(self, turns, last_active):
+        self.turns = turns
+        self.last_active = last_active
+
+
+class SessionStore:
+    """In-memory session table backed by a compressed log and snapshots
+
+    With `data_dir=None` sessions are kept in memory only. Call `recover()`
+    once at startup before serving requests.
+    """
+
+    def __init__(self, data_dir, zdict, snapshot_interval=5000, ttl=24 * 3600,
+                 fsync=True, clock=time.time):
+        self.data_dir = data_dir
+        self.zdict = zdict
+        self.snapshot_interval = snapshot_interval
+        self.ttl = ttl
+        self.fsync = fsync
+        self.clock = clock
+        self.sessions = {}
+        # `lock` guards the table and the log position; `sync_lock` serialises
+        # fsyncs and segment rotation. Always take sync_lock before lock.
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.seq = 0
+        self.synced_seq = 0
+        self.log_fd = None
+        self.log_size = 0
+        self.lock_file = None
+        self.turns_since_snapshot = 0
+        self.snapshotting = False
+        self.snapshot_thread = None
+
+    def _path(self, name):
+        return os.path.join(self.data_dir, name)
+
+    def _segments(self):
+        """Return (first_seq, path) for every log segment, oldest first"""
+        segments = []
+        for name in os.listdir(self.data_dir):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                first_seq = name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+                if first_seq.isdigit():
+                    segments.append((int(first_seq), self._path(name)))
+        return sorted(segments)
+
+    def _is_expired(self, session, now):
+        return bool(self.ttl) and now - session.last_active > self.ttl
+
+    def _expire(self, now):
+        """Drop idle sessions; must be called with lock held"""
+        expired = [sid for sid, session in self.sessions.items() if self._is_expired(session, now)]
+        for sid in expired:
+            del self.sessions[sid]
+        return len(expired)
+
+    def __contains__(self, session_id):
+        session = self.sessions.get(session_id)
+        return session is not None and not self._is_expired(session, self.clock())
+
+    def __len__(self):
+        now = self.clock()
+        return sum(1 for session in list(self.sessions.values()) if not self._is_expired(session, now))
+
+    def messages(self, session_id):
+        """Return a session's turns as the message dicts the API expects"""
+        return [{"role": ROLES[code], "content": content} for code, content in self.sessions[session_id].turns]
+
+    # -- recovery -----------------------------------------------------------
+
+    def recover(self):
+        """Rebuild the session table from the snapshot plus newer log segments
+
+        An unreadable snapshot, or a segment holding unreadable records, is
+        logged and renamed aside rather than overwritten, and recovery carries
+        on with what it can read. I/O errors propagate so boot fails loudly.
+        Afterwards the table is compacted into a fresh snapshot so the segments
+        start empty.
+        """
+        if self.data_dir is None:
+            return
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.lock_file = open(self._path(LOCK_NAME), 'a')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            self.lock_file = None
+            raise RuntimeError(
+                "Session data directory %s is in use by another process; "
+                "run a single worker (gunicorn --workers 1) or give each process "
+                "its own SESSION_DATA_DIR" % self.data_dir)
+
+        # Segments on disk were written with the stored dictionary, which may
+        # differ from the current one if the prompt changed since
+        log_zdict = self.zdict
+        try:
+            with open(self._path(ZDICT_NAME), 'rb') as f:
+                log_zdict = f.read()
+        except FileNotFoundError:
+            pass
+
+        sessions = {}
+        seq = 0
+        try:
+            with open(self._path(SNAPSHOT_NAME), 'rb') as f:
+                snapshot = json.loads(zlib.decompress(f.read()))
+            for sid, flat in snapshot["sessions"].items():
+                sessions[sid] = Session(list(zip(flat[1::2], flat[2::2])), flat[0])
+            seq = snapshot["seq"]
+        except FileNotFoundError:
+            pass
+        except DECODE_ERRORS:
+            corrupt_path = self._set_aside(self._path(SNAPSHOT_NAME))
+            logger.exception("Could not load session snapshot; moved it to %s and recovering "
+                             "from log segments only", corrupt_path)
+            sessions = {}
+            seq = 0
+
+        unreadable_segments = []
+        for _, path in self._segments():
+            for record_seq, payload in read_log(path):
+                if record_seq <= seq:
+                    continue
+                try:
+                    session_id, role_code, content, timestamp = decode_turn(log_zdict, payload)
+                    if role_code not in ROLE_CODES.values():
+                        raise ValueError("unknown role code %r" % (role_code,))
+                except DECODE_ERRORS:
+                    logger.exception("Skipping unreadable session log record %d in %s", record_seq, path)
+                    if path not in unreadable_segments:
+                        unreadable_segments.append(path)
+                    continue
+                session = sessions.get(session_id)
+                if session is None:
+                    session = sessions[session_id] = Session([], timestamp)
+                session.turns.append((role_code, content))
+                session.last_active = timestamp
+                seq = record_seq
+        for path in unreadable_segments:
+            logger.warning("Moved session log segment with unreadable records to %s", self._set_aside(path))
+
+        with self.sync_lock, self.lock:
+            self.sessions = sessions
+            self.seq = self.synced_seq = seq
+            self._expire(self.clock())
+            table = self._copy_table()
+        self._write_snapshot(table, seq)
+        self._delete_segments()
+        # The log is empty now, so new segments can use the current dictionary
+        self._write_file(ZDICT_NAME, self.zdict)
+        with self.sync_lock, self.lock:
+            self._open_segment(seq + 1)
+
+    def _set_aside(self, path):
+        """Rename an unreadable file so compaction keeps it; return the new path"""
+        corrupt_path = "%s.corrupt.%d" % (path, self.clock())
+        os.replace(path, corrupt_path)
+        return corrupt_path
+
+    # -- appending ----------------------------------------------------------
+
+    def append(self, session_id, role, content):
+        """Log a turn, then add it to the session in memory"""
+        role_code = ROLE_CODES[role]
+        now = self.clock()
+        payload = None
+        if self.log_fd is not None:
+            payload = encode_turn(self.zdict, session_id, role_code, content, now)
+        with self.lock:
+            seq = self.seq
+            if payload is not None:
+                seq += 1
+                self._write_record(seq, payload)
+                self.seq = seq
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = Session([], now)
+            session.turns.append((role_code, content))
+            session.last_active = now
+            self.turns_since_snapshot += 1
+            snapshot_due = self.turns_since_snapshot >= self.snapshot_interval and not self.snapshotting
+        if payload is not None and self.fsync:
+            self._sync(seq)
+        if snapshot_due:
+            self._start_snapshot()
+
+    def _write_record(self, seq, payload):
+        """Append one record to the current segment; must be called with lock held
+
+        A failed or short write is cut back off the segment so a torn record
+        never sits in front of later ones.
+        """
+        record = LOG_HEADER.pack(seq, len(payload), zlib.crc32(payload)) + payload
+        try:
+            written = os.write(self.log_fd, record)
+            if written != len(record):
+                raise OSError("short write to session log (%d of %d bytes)" % (written, len(record)))
+        except OSError:
+            try:
+                os.ftruncate(self.log_fd, self.log_size)
+            except OSError:
+                logger.exception("Could not truncate session log after failed write")
+            raise
+        self.log_size += len(record)
+
+    def _sync(self, seq):
+        """Group commit: one fsync covers every record written before it started"""
+        with self.sync_lock:
+            if self.synced_seq >= seq:
+                return
+            with self.lock:
+                fd, target = self.log_fd, self.seq
+            os.fsync(fd)
+            self.synced_seq = target
+
+    def _open_segment(self, first_seq):
+        """Start a new log segment; must be called with sync_lock and lock held"""
+        path = self._path(segment_name(first_seq))
+        self.log_fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.log_size = os.fstat(self.log_fd).st_size
+
+    def _close_segment(self):
+        """Flush and close the current segment; must be called with sync_lock and lock held"""
+        if self.log_fd is None:
+            return
+        os.fsync(self.log_fd)
+        os.close(self.log_fd)
+        self.log_fd = None
+        self.synced_seq = self.seq
+
+    # -- snapshots and compaction -------------------------------------------
+
+    def _copy_table(self):
+        """Shallow-copy the table for serialisation; must be called with lock held"""
+        return {sid: (session.last_active, list(session.turns)) for sid, session in self.sessions.items()}
+
+    def _start_snapshot(self):
+        """Expire idle sessions, rotate the log and snapshot a copy of the table in the background"""
+        with self.sync_lock, self.lock:
+            if self.snapshotting:
+                return
+            self._expire(self.clock())
+            self.turns_since_snapshot = 0
+            if self.log_fd is None:
+                return
+            table = self._copy_table()
+            seq = self.seq
+            self._close_segment()
+            self._open_segment(seq + 1)
+            self.snapshotting = True
+        self.snapshot_thread = threading.Thread(target=self._finish_snapshot, args=(table, seq), daemon=True)
+        self.snapshot_thread.start()
+
+    def _finish_snapshot(self, table, seq):
+        try:
+            self._write_snapshot(table, seq)
+            self._delete_segments(seq)
+        except Exception:
+            logger.exception("Session snapshot at seq %d failed; log segments kept", seq)
+        finally:
+            with self.lock:
+                self.snapshotting = False
+
+    def _write_file(self, name, data):
+        """Atomically replace a file in the data directory"""
+        path = self._path(name)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        dir_fd = os.open(self.data_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _write_snapshot(self, table, seq):
+        """Write a table copy as the snapshot covering every record up to `seq`"""
+        flat_table = {sid: [last_active] + [field for turn in turns for field in turn]
+                      for sid, (last_active, turns) in table.items()}
+        raw = json.dumps({"seq": seq, "sessions": flat_table}, separators=(',', ':')).encode('utf-8')
+        self._write_file(SNAPSHOT_NAME, zlib.compress(raw, 6))
+
+    def _delete_segments(self, seq=None):
+        """Delete segments whose records are all covered by the snapshot at `seq`, or all of them"""
+        for first_seq, path in self._segments():
+            if seq is None or first_seq <= seq:
+                os.remove(path)
+
+    def close(self):
+        """Wait for any snapshot in progress, then close the log and release the directory"""
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+        with self.sync_lock, self.lock:
+            self._close_segment()
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
@@ -0,0 +1,224 @@
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
+from session_store import (
+    ROLE_CODES,
+    SessionStore,
+    decode_turn,
+    encode_turn,
+)
+
+ZDICT = b"Hello, I'm the owner of Offshoot Intermediaries Limited. cinnamon powder Rs. /kg"
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def open_store(data_dir, zdict=ZDICT, **kwargs):
+    kwargs.setdefault("fsync", False)
+    store = SessionStore(str(data_dir), zdict, **kwargs)
+    store.recover()
+    return store
+
+
+def conversations(store):
+    return {sid: store.messages(sid) for sid in store.sessions}
+
+
+def segment_paths(data_dir):
+    return sorted(p for p in os.listdir(data_dir) if p.endswith(".log"))
+
+
+def test_encode_decode_round_trip():
+    payload = encode_turn(ZDICT, "s1", ROLE_CODES["user"], "I can do Rs. 450/kg ₹", 12.5)
+    assert tuple(decode_turn(ZDICT, payload)) == ("s1", ROLE_CODES["user"], "I can do Rs. 450/kg ₹", 12.5)
+
+
+def test_recover_after_restart(tmp_path):
+    store = open_store(tmp_path)
+    store.append("a", "assistant", "Hello")
+    store.append("a", "user", "Rs. 500/kg")
+    store.append("b", "assistant", "Hello")
+    before = conversations(store)
+    store.close()
+
+    store = open_store(tmp_path)
+    assert conversations(store) == before
+    assert store.messages("a") == [
+        {"role": "assistant", "content": "Hello"},
+        {"role": "user", "content": "Rs. 500/kg"},
+    ]
+    # New turns after recovery keep counting from the recovered sequence
+    store.append("a", "assistant", "Too high")
+    store.close()
+    store = open_store(tmp_path)
+    assert [m["content"] for m in store.messages("a")] == ["Hello", "Rs. 500/kg", "Too high"]
+    store.close()
+
+
+def test_torn_final_record_is_dropped(tmp_path):
+    store = open_store(tmp_path)
+    store.append("a", "assistant", "Hello")
+    store.append("a", "user", "Rs. 500/kg")
+    store.close()
+    (segment,) = segment_paths(tmp_path)
+    path = os.path.join(tmp_path, segment)
+    with open(path, "rb+") as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    store = open_store(tmp_path)
+    assert [m["content"] for m in store.messages("a")] == ["Hello"]
+    # Recovery compacts the torn segment away, so later turns are not lost behind it
+    store.append("a", "user", "Rs. 480/kg")
+    store.close()
+    store = open_store(tmp_path)
+    assert [m["content"] for m in store.messages("a")] == ["Hello", "Rs. 480/kg"]
+    store.close()
+
+
+def test_crash_between_snapshot_and_log_deletion_skips_covered_records(tmp_path):
+    store = open_store(tmp_path, snapshot_interval=3)
+    store.append("a", "assistant", "Hello")
+    store.append("a", "user", "Rs. 500/kg")
+    (segment,) = segment_paths(tmp_path)
+    saved = tmp_path / "saved.log"
+    shutil.copy(tmp_path / segment, saved)
+    store.append("a", "assistant", "Too high")  # triggers a snapshot and segment deletion
+    store.append("a", "user", "Rs. 450/kg")
+    store.close()
+    assert segment not in segment_paths(tmp_path)
+
+    # Put the covered segment back as if the process died before deleting it
+    shutil.copy(saved, tmp_path / segment)
+    store = open_store(tmp_path)
+    assert [m["content"] for m in store.messages("a")] == ["Hello", "Rs. 500/kg", "Too high", "Rs. 450/kg"]
+    store.close()
+
+
+def test_prompt_change_does_not_break_recovery(tmp_path):
+    store = open_store(tmp_path)
+    store.append("a", "assistant", "Hello")
+    store.append("a", "user", "Rs. 500/kg")
+    store.close()
+
+    store = open_store(tmp_path, zdict=ZDICT + b" One more sentence in the prompt.")
+    assert [m["content"] for m in store.messages("a")] == ["Hello", "Rs. 500/kg"]
+    store.append("a", "assistant", "Too high")
+    store.close()
+    store = open_store(tmp_path, zdict=ZDICT + b" One more sentence in the prompt.")
+    assert [m["content"] for m in store.messages("a")] == ["Hello", "Rs. 500/kg", "Too high"]
+    store.close()
+
+
+def test_corrupt_snapshot_is_set_aside(tmp_path):
+    store = open_store(tmp_path)
+    store.append("a", "assistant", "Hello")
+    store.close()
+    open_store(tmp_path).close()  # compacts "a" into the snapshot
+    store = open_store(tmp_path)
+    store.append("b", "assistant", "Hello")
+    store.close()
+    good_snapshot = (tmp_path / "sessions.snapshot").read_bytes()
+    (tmp_path / "sessions.snapshot").write_bytes(good_snapshot[:-1])
+
+    # The log tail still recovers, and the bad snapshot is kept for inspection
+    store = open_store(tmp_path)
+    assert set(store.sessions) == {"b"}
+    store.close()
+    (corrupt,) = [p for p in os.listdir(tmp_path) if p.startswith("sessions.snapshot.corrupt.")]
+    assert (tmp_path / corrupt).read_bytes() == good_snapshot[:-1]
+
+
+def test_segment_with_unreadable_records_is_set_aside(tmp_path):
+    store = open_store(tmp_path)
+    store.append("a", "assistant", "Hello")
+    store.close()
+    (segment,) = segment_paths(tmp_path)
+    (tmp_path / "sessions.zdict").write_bytes(b"a different dictionary")
+
+    store = open_store(tmp_path)
+    assert len(store) == 0
+    store.close()
+    assert [p for p in os.listdir(tmp_path) if p.startswith(segment + ".corrupt.")]
+
+
+def test_second_process_is_refused(tmp_path):
+    store = open_store(tmp_path)
+    with pytest.raises(RuntimeError):
+        open_store(tmp_path)
+    store.close()
+
+
+def test_len_excludes_expired_sessions(tmp_path):
+    clock = FakeClock()
+    store = open_store(tmp_path, ttl=60, clock=clock)
+    store.append("old", "assistant", "Hello")
+    clock.now += 120
+    store.append("new", "assistant", "Hello")
+    assert len(store) == 1
+    store.close()
+
+
+def test_idle_sessions_expire_at_compaction(tmp_path):
+    clock = FakeClock()
+    store = open_store(tmp_path, snapshot_interval=2, ttl=60, clock=clock)
+    store.append("old", "assistant", "Hello")
+    clock.now += 120
+    assert "old" not in store
+    store.append("new", "assistant", "Hello")  # triggers compaction
+    store.close()
+    assert set(store.sessions) == {"new"}
+
+    store = open_store(tmp_path, clock=clock, ttl=60)
+    assert set(store.sessions) == {"new"}
+    store.close()
+
+
+def test_concurrent_appends_during_background_snapshots(tmp_path):
+    store = open_store(tmp_path, snapshot_interval=50, fsync=True)
+
+    def chat(worker):
+        for i in range(200):
+            store.append("%d-%d" % (worker, i % 10), "user", "offer %d" % i)
+
+    threads = [threading.Thread(target=chat, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    before = conversations(store)
+    store.close()
+
+    store = open_store(tmp_path)
+    assert conversations(store) == before
+    assert sum(len(turns) for turns in before.values()) == 8 * 200
+    store.close()
+
+
+def test_replay_10k_sessions(tmp_path):
+    store = open_store(tmp_path, snapshot_interval=10 ** 9)
+    for i in range(10000):
+        sid = "session-%d" % i
+        store.append(sid, "assistant", "Hello, I'm the owner of Offshoot Intermediaries Limited.")
+        for price in (420, 410, 400):
+            store.append(sid, "user", "I can offer Rs. %d/kg for the full 1,000kg lot." % price)
+            store.append(sid, "assistant", "That is more than my other supplier charges.")
+    store.close()
+
+    start = time.perf_counter()
+    store = open_store(tmp_path)
+    elapsed = time.perf_counter() - start
+    assert len(store) == 10000
+    assert len(store.messages("session-9999")) == 7
+    store.close()
+    # Timing is reported rather than asserted so busy machines don't fail the run
+    print("replayed 10k sessions (70k turns) in %.2fs" % elapsed)